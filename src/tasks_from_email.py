@@ -1,4 +1,4 @@
-#!/usr/bin/python3.6
+#!/usr/bin/python3
 ################################################################################
 # tasks_from_email.py - Create kanboard tasks from email
 ################################################################################
@@ -36,11 +36,14 @@
 
 
 """ Import libraries and config file """
-import os, sys, imaplib, email, datetime, mailbox, kanboard, ssl, re, time, base64
+import os, sys, imaplib, email, datetime, mailbox, kanboard, ssl, re, time, base64, io, zlib, sqlite3, socket, contextlib
+import cProfile, json, logging, tracemalloc
 from os.path import basename, expanduser
 
 from configargparse import ArgumentParser
 
+logger = logging.getLogger(__name__)
+
 
 def get_arguments(parser):
     """Setup the provided ArgumentParser (a configargparse.ArgumentParser object) with arguments
@@ -56,6 +59,9 @@ def get_arguments(parser):
         ('--imaps-server', {'dest':'IMAPS_SERVER', 'help':'fqdn of mail sever', 'required':True}),
         ('--imaps-user', {'dest':'IMAPS_USERNAME', 'env_var':'IMAPS_USERNAME', 'help':'imap user name', 'required':True}),
         ('--imaps-password', {'dest':'IMAPS_PASSWORD', 'env_var':'IMAPS_PASSWORD', 'help':'imap user password', 'required':True}),
+        ('--imaps-disable-compress', {'dest':'IMAPS_DISABLE_COMPRESS', 'help':'do not use COMPRESS=DEFLATE even if the mail server supports it', 'action':'store_true'}),
+        ('--imaps-timeout', {'dest':'IMAPS_TIMEOUT', 'help':'socket timeout in seconds for the mail server connection', 'type':float, 'default':None}),
+        ('--imaps-read-buffer-size', {'dest':'IMAPS_READ_BUFFER_SIZE', 'help':'size in bytes of the buffer used to read from the mail server', 'type':int, 'default':None}),
         # kanboard
         ('--kanboard-connect-url', {'dest':'KANBOARD_CONNECT_URL', 'help':'url for API requests', 'required':True}),
         ('--kanboard-api-token', {'dest':'KANBOARD_API_TOKEN', 'help':'API token from a user that is allowed to create tasks', 'required':True}),
@@ -64,6 +70,12 @@ def get_arguments(parser):
         ('--kanboard-group-id', {'dest':'KANBOARD_GROUP_ID', 'help':"ID of group new users shall be added to. If set to 0 (default), the new user won't be added to a group.", 'default':0}),
         # various
         ('--well-known-email-addresses', {'dest':'WELL_KNOWN_EMAIL_ADDRESSES', 'help':'well-known mail addresses from where emails could be forwarded because they were sent to the wrong address', 'default':[]}),
+        # workers
+        ('--worker-lease-db', {'dest':'WORKER_LEASE_DB', 'help':'path to a SQLite database shared by several workers processing the same mailbox. If not set (default), a single worker is assumed.', 'default':None}),
+        ('--worker-lease-ttl', {'dest':'WORKER_LEASE_TTL', 'help':'Number of seconds after which leases of a crashed worker expire', 'type':int, 'default':300}),
+        # profiling
+        ('--profile', {'dest':'PROFILE_FILE', 'help':'write cProfile stats of the whole run to this file, they can be loaded with pstats or snakeviz', 'default':None}),
+        ('--trace-memory', {'dest':'TRACE_MEMORY_FILE', 'help':'write wall time, tracemalloc peak and top allocation sites of every mail as JSON lines to this file', 'default':None}),
     ]:
         name, params = arg
         params['env_var'] = params['dest']
@@ -101,10 +113,115 @@ def convert_to_kb_date(date_str, increment_by_hours=0):
     return local_kb_date
 
 
-def imap_connect(server, user, password):
-    """ connect and authenticate against mailserver """
-    imap_connection = imaplib.IMAP4_SSL(server)
+""" imaplib refuses commands it doesn't know, COMPRESS is only allowed once authenticated (RFC 4978) """
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+class DeflateIMAP4_SSL(imaplib.IMAP4_SSL):
+    """IMAP4_SSL client that can switch the connection to COMPRESS=DEFLATE (RFC 4978).
+
+    It also counts the bytes sent and received, both on the wire (wire_bytes_sent,
+    wire_bytes_received) and after decompression (bytes_sent, bytes_received).
+
+    Parameters
+    ----------
+    read_buffer_size: int, optional
+        Size of the buffer used to read from the socket, defaults to io.DEFAULT_BUFFER_SIZE
+    socket_timeout: float, optional
+        Timeout in seconds for connecting to and reading from or writing to the socket
+    """
+
+    def __init__(self, *args, read_buffer_size=None, socket_timeout=None, **kwargs):
+        self.read_buffer_size = read_buffer_size
+        self.socket_timeout = socket_timeout
+        self.compressed = False
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.wire_bytes_sent = 0
+        self.wire_bytes_received = 0
+        self._inflated = bytearray()
+        super().__init__(*args, **kwargs)
+
+    def _create_socket(self, *args):
+        """ connect with the socket timeout, imaplib only supports timeouts since python 3.9 """
+        if not self.socket_timeout:
+            return super()._create_socket(*args)
+        sock = socket.create_connection((self.host, self.port), self.socket_timeout)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+    def open(self, *args, **kwargs):
+        """ open the connection and replace the socket reader if a buffer size is configured """
+        super().open(*args, **kwargs)
+        if self.read_buffer_size:
+            self.file.close()
+            self.file = self.sock.makefile('rb', buffering=self.read_buffer_size)
+
+    def compress(self):
+        """ enable COMPRESS=DEFLATE if the server advertises it, returns True if it got enabled """
+        typ, data = self.capability()
+        if 'COMPRESS=DEFLATE' not in data[-1].decode('ascii').upper().split():
+            return False
+        typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        self._deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.compressed = True
+        return True
+
+    def _inflate_chunk(self):
+        """ read and inflate the next chunk from the socket, returns False on EOF """
+        chunk = self.file.read1(self.read_buffer_size or io.DEFAULT_BUFFER_SIZE)
+        self.wire_bytes_received += len(chunk)
+        self._inflated += self._inflater.decompress(chunk)
+        return bool(chunk)
+
+    def read(self, size):
+        """ read 'size' bytes from remote """
+        if self.compressed:
+            while len(self._inflated) < size and self._inflate_chunk():
+                pass
+            data = bytes(self._inflated[:size])
+            del self._inflated[:size]
+        else:
+            data = self.file.read(size)
+            self.wire_bytes_received += len(data)
+        self.bytes_received += len(data)
+        return data
+
+    def readline(self):
+        """ read line from remote """
+        if self.compressed:
+            while b'\n' not in self._inflated and len(self._inflated) <= imaplib._MAXLINE and self._inflate_chunk():
+                pass
+            end = self._inflated.find(b'\n') + 1 or len(self._inflated)
+            line = bytes(self._inflated[:min(end, imaplib._MAXLINE + 1)])
+            del self._inflated[:len(line)]
+        else:
+            line = self.file.readline(imaplib._MAXLINE + 1)
+            self.wire_bytes_received += len(line)
+        if len(line) > imaplib._MAXLINE:
+            raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+        self.bytes_received += len(line)
+        return line
+
+    def send(self, data):
+        """ send data to remote """
+        self.bytes_sent += len(data)
+        if self.compressed:
+            data = self._deflater.compress(data) + self._deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.wire_bytes_sent += len(data)
+        super().send(data)
+
+
+def imap_connect(server, user, password, compress=True, timeout=None, read_buffer_size=None):
+    """ connect and authenticate against mailserver
+
+        COMPRESS=DEFLATE gets enabled if compress is set and the server advertises it """
+    imap_connection = DeflateIMAP4_SSL(server, read_buffer_size=read_buffer_size, socket_timeout=timeout)
     imap_connection.login(user, password)
+    if compress:
+        imap_connection.compress()
     return imap_connection
 
 
@@ -115,9 +232,37 @@ def imap_close(imap_connection):
 
 
 def imap_search_unseen(imap_connection):
-    """ get unread mails """
+    """ get uids of unread mails """
     imap_connection.select('INBOX')
-    return imap_connection.search(None, 'unseen')
+    return imap_connection.uid('search', None, 'unseen')
+
+
+def imap_is_seen(imap_connection, uid):
+    """ check if a mail has been read in the meantime, mails that were deleted count as read """
+    typ, data = imap_connection.uid('fetch', uid, '(FLAGS)')
+    return data[0] is None or b'\\Seen' in imaplib.ParseFlags(data[0])
+
+
+def imap_fetch(imap_connection, uid, trace=None):
+    """ fetch a mail without marking it as read
+
+        fetch time and the bytes received on the wire and after decompression get added to
+        trace if it is set """
+    if trace is None:
+        return imap_connection.uid('fetch', uid, '(BODY.PEEK[])')
+    wire_bytes_received = imap_connection.wire_bytes_received
+    bytes_received = imap_connection.bytes_received
+    start = time.perf_counter()
+    result = imap_connection.uid('fetch', uid, '(BODY.PEEK[])')
+    trace.update(fetch_time=time.perf_counter() - start,
+                 wire_bytes_received=imap_connection.wire_bytes_received - wire_bytes_received,
+                 bytes_received=imap_connection.bytes_received - bytes_received)
+    return result
+
+
+def imap_mark_seen(imap_connection, uid):
+    """ mark a mail as read """
+    imap_connection.uid('store', uid, '+FLAGS', '(\\Seen)')
 
 
 def walk_message_parts(email_message):
@@ -174,25 +319,331 @@ def create_user_for_sender(kb, email_address):
         kb_user_id = kb.create_user(username=email_address, password=email_address, email=email_address)
     return kb_user_id
 
-def get_task_if_subject_matches(kb, subject):
-    """ search for link to already existing task """
+def get_task_if_subject_matches(kb, subject, kb_tasks=None):
+    """ search for link to already existing task
+
+        tasks already looked up are taken from kb_tasks (a dict of task id to task)
+        if it is passed so every task only gets fetched once per run """
     kb_task_id = False
     kb_task = None
     kb_task_search_result = re.findall('\[KB#\d+', '%s' % subject)
     if kb_task_search_result:
         kb_task_id = re.sub('\[KB#', '', kb_task_search_result[-1])
         """ test if task already exists """
-        kb_task = kb.get_task(task_id=kb_task_id)
+        if kb_tasks is not None and kb_task_id in kb_tasks:
+            kb_task = kb_tasks[kb_task_id]
+        else:
+            kb_task = kb.get_task(task_id=kb_task_id)
+            if kb_tasks is not None:
+                kb_tasks[kb_task_id] = kb_task
     return kb_task_id, kb_task
 
-def reopen_and_update(kb, kb_task, kb_task_id, kb_user_id, kb_text, local_task_due_date_ISO8601):
-    """ reopen task, update due date and add email as comment """
+def kb_date_sort_key(kb_date):
+    """ sort key for dates returned by convert_to_kb_date, missing dates sort first """
+    if kb_date is None:
+        return datetime.datetime.min
+    return datetime.datetime.strptime(kb_date, '%d.%m.%Y %H:%M')
+
+def reopen_and_update_batch(kb, kb_task, kb_task_id, kb_replies, previous_date_due=None):
+    """ reopen task once, add all emails replying to it as comments in date order
+        and update the due date to the latest one
+
+        kb_replies is a list of dicts with the keys user_id, text, date_started and date_due.
+        previous_date_due is the due date of the task as read before locking it. If kb_task has
+        a different one, another worker has updated the task since and its due date only gets
+        moved later. """
     if kb_task['is_active'] == 0:
         kb.open_task(task_id=kb_task_id)
-    """ add email as comment """
-    kb.create_comment(task_id=kb_task_id, user_id=kb_user_id, content=kb_text)
+    """ add emails as comments, sorted by date (stable for equal or missing dates) """
+    for kb_reply in sorted(kb_replies, key=lambda kb_reply: kb_date_sort_key(kb_reply['date_started'])):
+        kb.create_comment(task_id=kb_task_id, user_id=kb_reply['user_id'], content=kb_reply['text'])
+    local_task_due_date_ISO8601 = max((kb_reply['date_due'] for kb_reply in kb_replies), key=kb_date_sort_key)
+    if previous_date_due is not None and kb_task.get('date_due') != previous_date_due:
+        """ kanboard returns the due date as timestamp, 0 if none is set """
+        if local_task_due_date_ISO8601 is None or kb_date_sort_key(local_task_due_date_ISO8601).timestamp() <= int(kb_task.get('date_due') or 0):
+            return
     kb.update_task(id=kb_task_id, date_due=local_task_due_date_ISO8601)
 
+def reopen_and_update(kb, kb_task, kb_task_id, kb_user_id, kb_text, local_task_due_date_ISO8601):
+    """ reopen task, update due date and add email as comment """
+    reopen_and_update_batch(kb, kb_task, kb_task_id, [{'user_id': kb_user_id,
+                                                        'text': kb_text,
+                                                        'date_started': local_task_due_date_ISO8601,
+                                                        'date_due': local_task_due_date_ISO8601}])
+
+def upload_attachments(kb, kb_project_id, kb_task_id, subject, raw_email, kb_attachments):
+    """ add the email as an attachment to the task in case it's not properly displayed 
+        in the description or comment """
+    kb_attachments['%s.mbox' % re.sub('[^\w_.)( -]', '_', str(subject))] = base64.b64encode(raw_email)
+    for i in kb_attachments:
+        kb.create_task_file(project_id=str(kb_project_id), 
+                            task_id=str(kb_task_id), 
+                            filename=i, 
+                            blob=kb_attachments[i].decode('utf-8'))
+
+class LeaseStore:
+    """Leases shared by workers processing the same mailbox, stored in a SQLite database.
+
+    A lease is identified by its name and held by a single worker until it gets released or
+    expires after ttl seconds, so leases of crashed workers don't block the others forever.
+
+    Parameters
+    ----------
+    path: str, mandatory
+        Path to the SQLite database, it gets created if it doesn't exist
+    ttl: int, optional
+        Number of seconds a lease is valid
+    worker_id: str, optional
+        Identifies the worker holding a lease, defaults to hostname and pid
+    """
+
+    def __init__(self, path, ttl=300, worker_id=None):
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            """ acquire needs UPSERT """
+            raise RuntimeError('worker mode needs SQLite 3.24 or newer, found %s' % sqlite3.sqlite_version)
+        self.ttl = ttl
+        self.worker_id = worker_id or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS leases '
+                                '(name TEXT PRIMARY KEY, worker TEXT NOT NULL, expires REAL NOT NULL)')
+        self.connection.execute('DELETE FROM leases WHERE expires < ?', (time.time(),))
+
+    def acquire(self, name):
+        """ try to acquire or renew a lease, returns True if this worker holds it now """
+        now = time.time()
+        cursor = self.connection.execute('INSERT INTO leases (name, worker, expires) VALUES (?, ?, ?) '
+                                         'ON CONFLICT (name) DO UPDATE SET worker = excluded.worker, expires = excluded.expires '
+                                         'WHERE leases.expires < ? OR leases.worker = excluded.worker',
+                                         (name, self.worker_id, now + self.ttl, now))
+        return cursor.rowcount == 1
+
+    def renew(self):
+        """ renew all leases held by this worker """
+        self.connection.execute('UPDATE leases SET expires = ? WHERE worker = ?', (time.time() + self.ttl, self.worker_id))
+
+    def release(self, name):
+        """ release a lease held by this worker """
+        self.connection.execute('DELETE FROM leases WHERE name = ? AND worker = ?', (name, self.worker_id))
+
+    @contextlib.contextmanager
+    def lock(self, name, poll_interval=0.1):
+        """ hold a lease for the duration of a with block, waits until it is available """
+        while not self.acquire(name):
+            time.sleep(poll_interval)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def close(self):
+        """ close the database connection """
+        self.connection.close()
+
+def lease_lock(leases, name):
+    """ lock name in the LeaseStore leases, does nothing if there is only a single worker (leases is None) """
+    if leases is None:
+        return contextlib.nullcontext()
+    return leases.lock(name)
+
+""" number of frames tracemalloc records, allocations in the standard library need a few to be
+    traced back to the line in this script that caused them """
+TRACE_MEMORY_FRAMES = 25
+
+def allocation_site(stat):
+    """ describe a tracemalloc.StatisticDiff grouped by traceback by the innermost line of this
+        script it was allocated from (or the innermost line if there is none) and its traceback """
+    frames = list(stat.traceback)
+    own_frames = [frame for frame in frames if frame.filename == __file__]
+    site = (own_frames or frames)[-1]
+    return {'file': site.filename,
+            'line': site.lineno,
+            'size': stat.size_diff,
+            'count': stat.count_diff,
+            'traceback': ['%s:%d' % (frame.filename, frame.lineno) for frame in frames]}
+
+@contextlib.contextmanager
+def trace_memory(report, top_allocations=10, **tags):
+    """ measure wall time, memory peak and top allocation sites of a with block and write them
+        together with tags as a JSON line to report
+
+        the yielded dict can be updated to add tags from inside the with block, nothing gets
+        measured if report is None. Tracing that is already running (e.g. PYTHONTRACEMALLOC) is
+        used and left running, the peak then is only accurate since python 3.9. """
+    trace = dict(tags)
+    if report is None:
+        yield trace
+        return
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start(TRACE_MEMORY_FRAMES)
+    elif hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    start_snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace['wall_time'] = time.perf_counter() - start
+        trace['memory_peak'] = max(tracemalloc.get_traced_memory()[1] - start_memory, 0)
+        snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+        if not was_tracing:
+            tracemalloc.stop()
+        stats = sorted(snapshot.compare_to(start_snapshot, 'traceback'), key=lambda stat: stat.size_diff, reverse=True)
+        trace['top_allocations'] = [allocation_site(stat) for stat in stats[:top_allocations]]
+        report.write(json.dumps(trace, default=str) + '\n')
+
+def apply_replies(kb, imap_connection, kb_replies, leases=None, report=None):
+    """ reopen and update every task only once with the replies collected for it, upload their
+        attachments and mark them as read
+
+        errors are logged per task so the replies for the other tasks still get applied, replies
+        for a failed task stay unread so the next run retries them. Returns the errors. """
+    errors = []
+    for kb_task_id, (kb_task, kb_project_id, kb_task_replies) in kb_replies.items():
+        if leases:
+            """ keep the claims of mails that aren't marked as read yet """
+            leases.renew()
+        try:
+            with trace_memory(report, phase='task', task_id=kb_task_id,
+                              messages=[{'message_id': kb_reply['message_id'], 'size': len(kb_reply['raw_email'])}
+                                        for kb_reply in kb_task_replies]):
+                with lease_lock(leases, 'task:%s' % kb_task_id):
+                    previous_date_due = None
+                    if leases:
+                        """ another worker might have changed the task since it was read """
+                        previous_date_due = kb_task.get('date_due')
+                        kb_task = kb.get_task(task_id=kb_task_id) or kb_task
+                    reopen_and_update_batch(kb, kb_task, kb_task_id, kb_task_replies, previous_date_due)
+                for kb_reply in kb_task_replies:
+                    upload_attachments(kb, kb_project_id, kb_task_id, kb_reply['subject'], kb_reply['raw_email'], kb_reply['attachments'])
+            for kb_reply in kb_task_replies:
+                imap_mark_seen(imap_connection, kb_reply['uid'])
+        except Exception as error:
+            logger.exception('applying %d replies to task %s failed', len(kb_task_replies), kb_task_id)
+            errors.append(error)
+    return errors
+
+def process_unseen_mails(args, report=None):
+    """ create or update tasks for all unread mails
+
+        per mail measurements get written to report if it is set, see trace_memory """
+    imap_connection = imap_connect(args.IMAPS_SERVER,
+                                   args.IMAPS_USERNAME,
+                                   args.IMAPS_PASSWORD,
+                                   compress=not args.IMAPS_DISABLE_COMPRESS,
+                                   timeout=args.IMAPS_TIMEOUT,
+                                   read_buffer_size=args.IMAPS_READ_BUFFER_SIZE)
+    leases = None
+    try:
+        typ, data = imap_search_unseen(imap_connection)
+
+        """ workers sharing the mailbox claim each mail by its uid, which is only unique per uidvalidity """
+        if args.WORKER_LEASE_DB:
+            leases = LeaseStore(args.WORKER_LEASE_DB, args.WORKER_LEASE_TTL)
+            uidvalidity = imap_connection.response('UIDVALIDITY')[1][-1].decode('ascii')
+
+        """ connect to kanboard api """
+        kb = kanboard.Client(args.KANBOARD_CONNECT_URL+'/jsonrpc.php', 'jsonrpc', args.KANBOARD_API_TOKEN)
+
+        """ replies to existing tasks get collected per task and applied after all mails were read,
+            mails are only marked as read once they were handled """
+        kb_tasks = {}
+        kb_replies = {}
+
+        try:
+            for num in data[0].split():
+                """ for each unread mail do """
+                if leases:
+                    """ keep the claims of mails that aren't marked as read yet """
+                    leases.renew()
+                if leases and not leases.acquire('message:%s:%s' % (uidvalidity, num.decode('ascii'))):
+                    """ another worker is already handling this mail """
+                    continue
+                if leases and imap_is_seen(imap_connection, num):
+                    """ another worker has handled this mail already and its claim expired """
+                    continue
+                with trace_memory(report, phase='message') as trace:
+                    try:
+                        typ, data = imap_fetch(imap_connection, num, trace if report else None)
+                        raw_email = data[0][1]
+                        email_message = email.message_from_bytes(raw_email)
+                        message_id = email_message['Message-ID']
+                        trace.update(uid=num.decode('ascii'), message_id=message_id, size=len(raw_email))
+
+                        local_task_start_date_ISO8601 = convert_to_kb_date(email_message['Date'])
+                        local_task_due_date_ISO8601 = convert_to_kb_date(email_message['Date'], 
+                                                                         args.KANBOARD_TASK_DUE_OFFSET_IN_HOURS)
+                        email_from = email_message['From']
+                        """ extract email address if specified as 'name <email address>' """
+                        email_address=re.sub('[<>]', '', re.findall('\S+@\S+', email_from)[-1])
+                        email_to = email_message['To']
+                        subject = email.header.make_header(email.header.decode_header(email_message['Subject']))
+
+                        body, kb_attachments = walk_message_parts(email_message)
+
+                        email_address, local_task_start_date_ISO8601, local_task_due_date_ISO8601 = handle_well_known_forwarders(args.WELL_KNOWN_EMAIL_ADDRESSES, args.KANBOARD_TASK_DUE_OFFSET_IN_HOURS, body, email_address, local_task_start_date_ISO8601, local_task_due_date_ISO8601)
+
+                        kb_text = 'From: %s\n\nTo: %s\n\nDate: %s\n\nSubject: %s\n\n%s' % (email_from, 
+                                                                                           email_to, 
+                                                                                           local_task_start_date_ISO8601, 
+                                                                                           subject, 
+                                                                                           body)
+
+                        with lease_lock(leases, 'sender:%s' % email_address.lower()):
+                            kb_user_id = create_user_for_sender(kb, email_address)
+
+                            """ add user to group """
+                            if args.KANBOARD_GROUP_ID > 0:  # pragma: no cover - will get tested once config is refactored
+                                kb.add_group_member(group_id=args.KANBOARD_GROUP_ID, user_id=kb_user_id)
+
+                        """ get id from project specified """
+                        kb_project_id = kb.get_project_by_name(name=str(args.KANBOARD_PROJECT_NAME))['id']
+
+                        kb_task_id, kb_task = get_task_if_subject_matches(kb, subject, kb_tasks)
+
+                        if kb_task:
+                            kb_replies.setdefault(kb_task_id, (kb_task, kb_project_id, []))[2].append({
+                                'uid': num,
+                                'user_id': kb_user_id,
+                                'text': kb_text,
+                                'date_started': local_task_start_date_ISO8601,
+                                'date_due': local_task_due_date_ISO8601,
+                                'subject': subject,
+                                'message_id': message_id,
+                                'raw_email': raw_email,
+                                'attachments': kb_attachments,
+                            })
+                            continue
+
+                        """ create task in project specified """
+                        kb_task_id = kb.create_task(project_id=str(kb_project_id), 
+                                                                   title=str(subject), 
+                                                                   creator_id=kb_user_id, 
+                                                                   date_started=local_task_start_date_ISO8601, 
+                                                                   date_due=local_task_due_date_ISO8601, 
+                                                                   description=kb_text)
+
+                        if kb_task_id != False:
+                            upload_attachments(kb, kb_project_id, kb_task_id, subject, raw_email, kb_attachments)
+                    except Exception:
+                        """ a failing mail gets marked as read so it can't keep later runs from getting to the other mails """
+                        imap_mark_seen(imap_connection, num)
+                        raise
+                    imap_mark_seen(imap_connection, num)
+        finally:
+            """ apply the replies collected so far even if a later mail failed, errors get raised once
+                all tasks were updated unless a mail failed already """
+            errors = apply_replies(kb, imap_connection, kb_replies, leases, report)
+        if errors:
+            raise errors[0]
+    finally:
+        imap_close(imap_connection)
+        if leases:
+            leases.close()
+
+
 def main():
     """main function"""
     default_config_file = 'tasks_from_email.conf'
@@ -211,70 +662,21 @@ def main():
                 description='Kanboard Tasks from Email.')
     args = get_arguments(parser)
 
-    imap_connection = imap_connect(args.IMAPS_SERVER, args.IMAPS_USERNAME, args.IMAPS_PASSWORD)
-    typ, data = imap_search_unseen(imap_connection)
-
-    for num in data[0].split():
-        """ for each unread mail do """
-        typ, data = imap_connection.fetch(num, '(RFC822)')
-        raw_email = data[0][1]
-        email_message = email.message_from_bytes(raw_email)
-
-        local_task_start_date_ISO8601 = convert_to_kb_date(email_message['Date'])
-        local_task_due_date_ISO8601 = convert_to_kb_date(email_message['Date'], 
-                                                         args.KANBOARD_TASK_DUE_OFFSET_IN_HOURS)
-        email_from = email_message['From']
-        """ extract email address if specified as 'name <email address>' """
-        email_address=re.sub('[<>]', '', re.findall('\S+@\S+', email_from)[-1])
-        email_to = email_message['To']
-        subject = email.header.make_header(email.header.decode_header(email_message['Subject']))
-
-        body, kb_attachments = walk_message_parts(email_message)
-
-        email_address, local_task_start_date_ISO8601, local_task_due_date_ISO8601 = handle_well_known_forwarders(args.WELL_KNOWN_EMAIL_ADDRESSES, args.KANBOARD_TASK_DUE_OFFSET_IN_HOURS, body, email_address, local_task_start_date_ISO8601, local_task_due_date_ISO8601)
-
-        kb_text = 'From: %s\n\nTo: %s\n\nDate: %s\n\nSubject: %s\n\n%s' % (email_from, 
-                                                                           email_to, 
-                                                                           local_task_start_date_ISO8601, 
-                                                                           subject, 
-                                                                           body)
-
-        """ connect to kanboard api """
-        kb = kanboard.Client(args.KANBOARD_CONNECT_URL+'/jsonrpc.php', 'jsonrpc', args.KANBOARD_API_TOKEN)
-
-        kb_user_id = create_user_for_sender(kb, email_address)
-
-        """ add user to group """
-        if args.KANBOARD_GROUP_ID > 0:  # pragma: no cover - will get tested once config is refactored
-            kb.add_group_member(group_id=args.KANBOARD_GROUP_ID, user_id=kb_user_id)
-
-        """ get id from project specified """
-        kb_project_id = kb.get_project_by_name(name=str(args.KANBOARD_PROJECT_NAME))['id']
-
-        kb_task_id, kb_task = get_task_if_subject_matches(kb, subject)
-
-        if kb_task:
-            reopen_and_update(kb, kb_task, kb_task_id, kb_user_id, kb_text, local_task_due_date_ISO8601)
-        else:
-            """ create task in project specified """
-            kb_task_id = kb.create_task(project_id=str(kb_project_id), 
-                                                       title=str(subject), 
-                                                       creator_id=kb_user_id, 
-                                                       date_started=local_task_start_date_ISO8601, 
-                                                       date_due=local_task_due_date_ISO8601, 
-                                                       description=kb_text)
-
-        """ add the email as an attachment to the task in case it's not properly displayed 
-            in the description or comment """
-        if kb_task_id != False:
-            kb_attachments['%s.mbox' % re.sub('[^\w_.)( -]', '_', str(subject))] = base64.b64encode(raw_email)
-            for i in kb_attachments:
-                kb.create_task_file(project_id=str(kb_project_id), 
-                                    task_id=str(kb_task_id), 
-                                    filename=i, 
-                                    blob=kb_attachments[i].decode('utf-8'))
-
-    imap_close(imap_connection)
+    profiler = None
+    if args.PROFILE_FILE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    report = None
+    if args.TRACE_MEMORY_FILE:
+        report = open(args.TRACE_MEMORY_FILE, 'w')
+    try:
+        process_unseen_mails(args, report)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.PROFILE_FILE)
+        if report:
+            report.close()
 
 
 if __name__ == "__main__":   # pragma: no cover
@@ -24,3 +24,12 @@ class TestGetTaskIfSubjectMatches:
         result = get_task_if_subject_matches(kb, subject)
         assert result == expected
         kb.get_task.assert_called_with(task_id=expected[0])
+
+    def test_call_with_task_cache(self, kb):
+        kb.get_task.return_value = {"id": 956}
+        kb_tasks = {}
+        first = get_task_if_subject_matches(kb, "[KB#956] first", kb_tasks)
+        second = get_task_if_subject_matches(kb, "Re: [KB#956] second", kb_tasks)
+        assert first == second == ("956", {"id": 956})
+        assert kb_tasks == {"956": {"id": 956}}
+        kb.get_task.assert_called_once_with(task_id="956")
@@ -2,21 +2,35 @@ import pytest
 from unittest.mock import Mock
 
 import imaplib
+import io
+import socket
+import zlib
 
-from tasks_from_email import imap_connect, imap_close, imap_search_unseen
+import tasks_from_email
+from tasks_from_email import DeflateIMAP4_SSL, imap_connect, imap_close, imap_fetch, imap_is_seen, imap_mark_seen, imap_search_unseen
 
 class TestImapFunctions:
-    def test_imap_connect(self, mocker):
-        mocker.patch('imaplib.IMAP4_SSL')
+    @pytest.mark.parametrize("compress", [(True), (False)])
+    def test_imap_connect(self, mocker, compress):
+        mocker.patch('tasks_from_email.DeflateIMAP4_SSL')
 
         connection = Mock()
-        imaplib.IMAP4_SSL.return_value = connection
+        tasks_from_email.DeflateIMAP4_SSL.return_value = connection
 
-        imap_connection = imap_connect('servername', 'username', 'password')
+        imap_connection = imap_connect('servername', 'username', 'password', compress=compress)
 
-        imaplib.IMAP4_SSL.assert_called_once_with('servername')
+        tasks_from_email.DeflateIMAP4_SSL.assert_called_once_with('servername', read_buffer_size=None, socket_timeout=None)
+        connection.login.assert_called_once_with('username', 'password')
+        assert connection.compress.called == compress
         assert imap_connection == connection
 
+    def test_imap_connect_with_tuning(self, mocker):
+        mocker.patch('tasks_from_email.DeflateIMAP4_SSL')
+
+        imap_connect('servername', 'username', 'password', timeout=10, read_buffer_size=65536)
+
+        tasks_from_email.DeflateIMAP4_SSL.assert_called_once_with('servername', read_buffer_size=65536, socket_timeout=10)
+
     def test_imap_close(self):
         imap_connection = Mock()
 
@@ -27,11 +41,204 @@ class TestImapFunctions:
 
     def test_image_search_unseen(self):
         imap_connection = Mock()
-        imap_connection.search.return_value = ('typ', 'data')
+        imap_connection.uid.return_value = ('typ', 'data')
 
         typ, data = imap_search_unseen(imap_connection)
 
         imap_connection.select.assert_called_once_with('INBOX')
-        imap_connection.search.assert_called_once_with(None, 'unseen')
+        imap_connection.uid.assert_called_once_with('search', None, 'unseen')
         assert typ == 'typ'
         assert data == 'data'
+
+    @pytest.mark.parametrize(
+        "data,expected",
+        [
+            ([b'1 (UID 956 FLAGS (\\Seen \\Answered))'], True),
+            ([b'1 (UID 956 FLAGS (\\Answered))'], False),
+            ([b'1 (UID 956 FLAGS ())'], False),
+            ([None], True),
+        ],
+    )
+    def test_imap_is_seen(self, data, expected):
+        imap_connection = Mock()
+        imap_connection.uid.return_value = ('OK', data)
+
+        assert imap_is_seen(imap_connection, b'956') == expected
+        imap_connection.uid.assert_called_once_with('fetch', b'956', '(FLAGS)')
+
+    def test_imap_fetch(self):
+        imap_connection = Mock()
+        imap_connection.uid.return_value = ('OK', [(b'1 (UID 956 BODY[] {3}', b'raw')])
+
+        assert imap_fetch(imap_connection, b'956') == ('OK', [(b'1 (UID 956 BODY[] {3}', b'raw')])
+        imap_connection.uid.assert_called_once_with('fetch', b'956', '(BODY.PEEK[])')
+
+    def test_imap_fetch_with_trace(self):
+        imap_connection = Mock()
+        imap_connection.wire_bytes_received = 100
+        imap_connection.bytes_received = 200
+
+        def uid(command, num, parts):
+            imap_connection.wire_bytes_received += 30
+            imap_connection.bytes_received += 90
+            return ('OK', [(b'1 (UID 956 BODY[] {3}', b'raw')])
+
+        imap_connection.uid.side_effect = uid
+        trace = {'uid': '956'}
+
+        imap_fetch(imap_connection, b'956', trace)
+
+        assert trace['uid'] == '956'
+        assert trace['wire_bytes_received'] == 30
+        assert trace['bytes_received'] == 90
+        assert trace['fetch_time'] >= 0
+
+    def test_imap_mark_seen(self):
+        imap_connection = Mock()
+
+        imap_mark_seen(imap_connection, b'956')
+
+        imap_connection.uid.assert_called_once_with('store', b'956', '+FLAGS', '(\\Seen)')
+
+
+def deflate(data):
+    deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return deflater.compress(data) + deflater.flush(zlib.Z_SYNC_FLUSH)
+
+
+class TestDeflateIMAP4_SSL:
+    @pytest.fixture
+    def connection(self, mocker):
+        """ a DeflateIMAP4_SSL that doesn't connect, set file to feed it server responses """
+        mocker.patch('imaplib.IMAP4_SSL.__init__', return_value=None)
+        connection = DeflateIMAP4_SSL('servername')
+        connection.sock = Mock()
+        connection.capability = Mock(return_value=('OK', [b'IMAP4rev1 COMPRESS=DEFLATE']))
+        connection._simple_command = Mock(return_value=('OK', [b'DEFLATE active']))
+        return connection
+
+    def test_open_with_read_buffer_size(self, mocker):
+        mocker.patch('imaplib.IMAP4_SSL.open')
+        mocker.patch('imaplib.IMAP4_SSL.__init__', return_value=None)
+        connection = DeflateIMAP4_SSL('servername', read_buffer_size=65536)
+        connection.file = Mock()
+        connection.sock = Mock()
+
+        connection.open('servername', 993)
+
+        imaplib.IMAP4_SSL.open.assert_called_once_with('servername', 993)
+        connection.sock.makefile.assert_called_once_with('rb', buffering=65536)
+        assert connection.file == connection.sock.makefile.return_value
+
+    def test_create_socket_with_socket_timeout(self, mocker):
+        mocker.patch('socket.create_connection')
+        mocker.patch('imaplib.IMAP4_SSL.__init__', return_value=None)
+        connection = DeflateIMAP4_SSL('servername', socket_timeout=10)
+        connection.host = 'servername'
+        connection.port = 993
+        connection.ssl_context = Mock()
+
+        sock = connection._create_socket()
+
+        socket.create_connection.assert_called_once_with(('servername', 993), 10)
+        connection.ssl_context.wrap_socket.assert_called_once_with(socket.create_connection.return_value,
+                                                                   server_hostname='servername')
+        assert sock == connection.ssl_context.wrap_socket.return_value
+
+    def test_create_socket_without_socket_timeout(self, mocker):
+        mocker.patch('imaplib.IMAP4_SSL._create_socket')
+        mocker.patch('imaplib.IMAP4_SSL.__init__', return_value=None)
+        connection = DeflateIMAP4_SSL('servername')
+
+        sock = connection._create_socket(None)
+
+        imaplib.IMAP4_SSL._create_socket.assert_called_once_with(None)
+        assert sock == imaplib.IMAP4_SSL._create_socket.return_value
+
+    def test_open_without_read_buffer_size(self, mocker):
+        mocker.patch('imaplib.IMAP4_SSL.open')
+        mocker.patch('imaplib.IMAP4_SSL.__init__', return_value=None)
+        connection = DeflateIMAP4_SSL('servername')
+        connection.sock = Mock()
+
+        connection.open('servername', 993)
+
+        connection.sock.makefile.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "capabilities,typ,expected",
+        [
+            ([b'IMAP4rev1 COMPRESS=DEFLATE'], 'OK', True),
+            ([b'IMAP4rev1 compress=deflate'], 'OK', True),
+            ([b'IMAP4rev1 COMPRESS=DEFLATE'], 'NO', False),
+            ([b'IMAP4rev1 IDLE'], 'OK', False),
+        ],
+    )
+    def test_compress(self, connection, capabilities, typ, expected):
+        connection.capability.return_value = ('OK', capabilities)
+        connection._simple_command.return_value = (typ, [b''])
+
+        assert connection.compress() == expected
+        assert connection.compressed == expected
+        if 'COMPRESS=DEFLATE' in capabilities[0].decode().upper():
+            connection._simple_command.assert_called_once_with('COMPRESS', 'DEFLATE')
+        else:
+            connection._simple_command.assert_not_called()
+
+    def test_uncompressed_read(self, connection):
+        connection.file = io.BufferedReader(io.BytesIO(b'* 1 FETCH (RFC822 {5}\r\nhello)\r\n'))
+
+        assert connection.readline() == b'* 1 FETCH (RFC822 {5}\r\n'
+        assert connection.read(5) == b'hello'
+        assert connection.readline() == b')\r\n'
+        assert connection.bytes_received == connection.wire_bytes_received == 31
+
+    def test_compressed_read(self, connection):
+        connection.compress()
+        connection.read_buffer_size = 4
+        connection.file = io.BufferedReader(io.BytesIO(deflate(b'* 1 FETCH (RFC822 {5}\r\nhello)\r\n')))
+
+        assert connection.readline() == b'* 1 FETCH (RFC822 {5}\r\n'
+        assert connection.read(5) == b'hello'
+        assert connection.readline() == b')\r\n'
+        assert connection.readline() == b''
+        assert connection.read(1) == b''
+        assert connection.bytes_received == 31
+
+    @pytest.mark.parametrize("compress", [(True), (False)])
+    def test_readline_too_long(self, connection, compress):
+        if compress:
+            connection.compress()
+        data = b'x' * (imaplib._MAXLINE + 10) + b'\r\n'
+        connection.file = io.BufferedReader(io.BytesIO(deflate(data) if compress else data))
+
+        with pytest.raises(imaplib.IMAP4.error):
+            connection.readline()
+
+    def test_compressed_send(self, connection):
+        connection.compress()
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        connection.send(b'a001 NOOP\r\n')
+
+        sent = connection.sock.sendall.call_args[0][0]
+        assert inflater.decompress(sent) == b'a001 NOOP\r\n'
+        assert connection.bytes_sent == 11
+        assert connection.wire_bytes_sent == len(sent)
+
+    def test_compression_saves_bytes_on_the_wire(self, connection):
+        """ text mails like the ones we fetch should shrink considerably """
+        body = b'Hello support,\r\n\r\nthe printer in the studio is broken again.\r\n\r\nRegards\r\n' * 50
+        response = b'* 1 FETCH (RFC822 {%d}\r\n%s)\r\n' % (len(body), body)
+        connection.file = io.BufferedReader(io.BytesIO(response))
+        connection.readline()
+        connection.read(len(body))
+        uncompressed_wire_bytes = connection.wire_bytes_received
+
+        connection.wire_bytes_received = 0
+        connection.compress()
+        connection.file = io.BufferedReader(io.BytesIO(deflate(response)))
+        connection.readline()
+        assert connection.read(len(body)) == body
+
+        assert connection.wire_bytes_received * 5 < uncompressed_wire_bytes
@@ -0,0 +1,104 @@
+import pytest
+import threading
+import time
+
+from tasks_from_email import LeaseStore, lease_lock
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "leases.db")
+
+
+class TestLeaseStore:
+    def test_old_sqlite(self, path, mocker):
+        mocker.patch("sqlite3.sqlite_version_info", (3, 23, 1))
+        mocker.patch("sqlite3.sqlite_version", "3.23.1")
+
+        with pytest.raises(RuntimeError, match="SQLite 3.24 or newer, found 3.23.1"):
+            LeaseStore(path)
+
+    def test_acquire_is_exclusive(self, path):
+        first = LeaseStore(path, worker_id="first")
+        second = LeaseStore(path, worker_id="second")
+
+        assert first.acquire("message:1:956")
+        assert not second.acquire("message:1:956")
+        assert second.acquire("message:1:957")
+
+    def test_acquire_renews_own_lease(self, path):
+        worker = LeaseStore(path, worker_id="worker")
+
+        assert worker.acquire("task:956")
+        assert worker.acquire("task:956")
+
+    def test_acquire_expired_lease(self, path, mocker):
+        crashed = LeaseStore(path, ttl=10, worker_id="crashed")
+        other = LeaseStore(path, ttl=10, worker_id="other")
+        assert crashed.acquire("task:956")
+
+        mocker.patch("time.time", return_value=time.time() + 11)
+
+        assert other.acquire("task:956")
+        assert not crashed.acquire("task:956")
+
+    def test_expired_leases_are_pruned(self, path, mocker):
+        LeaseStore(path, ttl=10, worker_id="crashed").acquire("task:956")
+
+        mocker.patch("time.time", return_value=time.time() + 11)
+        leases = LeaseStore(path, ttl=10)
+
+        assert leases.connection.execute("SELECT COUNT(*) FROM leases").fetchone() == (0,)
+
+    def test_renew(self, path, mocker):
+        worker = LeaseStore(path, ttl=10, worker_id="worker")
+        other = LeaseStore(path, ttl=10, worker_id="other")
+        worker.acquire("message:1:956")
+        worker.acquire("message:1:957")
+        now = time.time()
+
+        mocker.patch("time.time", return_value=now + 8)
+        worker.renew()
+        mocker.patch("time.time", return_value=now + 16)
+
+        assert not other.acquire("message:1:956")
+        assert not other.acquire("message:1:957")
+
+    def test_release(self, path):
+        first = LeaseStore(path, worker_id="first")
+        second = LeaseStore(path, worker_id="second")
+        first.acquire("sender:from@example.org")
+
+        second.release("sender:from@example.org")
+        assert not second.acquire("sender:from@example.org")
+
+        first.release("sender:from@example.org")
+        assert second.acquire("sender:from@example.org")
+
+    def test_lock_waits_for_other_worker(self, path):
+        first = LeaseStore(path, worker_id="first")
+        first.acquire("task:956")
+        """ sqlite connections can't be shared between threads """
+        timer = threading.Timer(0.2, lambda: LeaseStore(path, worker_id="first").release("task:956"))
+        timer.start()
+
+        start = time.time()
+        with lease_lock(LeaseStore(path, worker_id="second"), "task:956"):
+            assert time.time() - start >= 0.2
+            assert not first.acquire("task:956")
+        timer.join()
+        assert first.acquire("task:956")
+
+    def test_lock_releases_on_error(self, path):
+        worker = LeaseStore(path, worker_id="worker")
+        other = LeaseStore(path, worker_id="other")
+
+        with pytest.raises(RuntimeError):
+            with worker.lock("task:956"):
+                raise RuntimeError()
+
+        assert other.acquire("task:956")
+
+    def test_lease_lock_without_store(self):
+        with lease_lock(None, "task:956"):
+            pass
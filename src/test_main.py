@@ -1,12 +1,35 @@
 import pytest
 from unittest.mock import Mock, call
+from os import environ
 
+import datetime
 import email
+import json
+import pstats
+import threading
 import kanboard
 
 import tasks_from_email
 
 
+def mock_imap_connection(raw_emails, seen=()):
+    """ mock an imap connection serving raw_emails by uid, mails in seen or stored as read are \\Seen """
+    imap_connection = Mock()
+    imap_connection.seen = set(seen)
+
+    def uid(command, num, *args):
+        if command == "store":
+            imap_connection.seen.add(num)
+            return ("OK", [None])
+        if args[0] == "(FLAGS)":
+            flags = b"\\Seen" if num in imap_connection.seen else b""
+            return ("OK", [b"1 (UID " + num + b" FLAGS (" + flags + b"))"])
+        return ("OK", [(None, raw_emails[num])])
+
+    imap_connection.uid.side_effect = uid
+    return imap_connection
+
+
 class TestMain:
     def test_call_no_results(self, mocker):
         mocker.patch("tasks_from_email.imap_connect")
@@ -29,21 +52,22 @@ class TestMain:
         mocker.patch("tasks_from_email.convert_to_kb_date")
         mocker.patch("tasks_from_email.create_user_for_sender")
         mocker.patch("tasks_from_email.get_task_if_subject_matches")
-        mocker.patch("tasks_from_email.reopen_and_update")
+        mocker.patch("tasks_from_email.reopen_and_update_batch")
         mocker.patch("email.message_from_bytes")
         mocker.patch("email.header.make_header")
         mocker.patch("kanboard.Client")
 
         imap_connection = Mock()
-        imap_connection.fetch.return_value = ("typ", [(None, b"raw")])
+        imap_connection.uid.return_value = ("typ", [(None, b"raw")])
         tasks_from_email.imap_connect.return_value = imap_connection
-        tasks_from_email.imap_search_unseen.return_value = ("typ", ["a"])
+        tasks_from_email.imap_search_unseen.return_value = ("typ", [b"a"])
         email.message_from_bytes.return_value = email_message
         mock_data = {
             "Date": "rfcdate",
             "From": "from@example.org",
             "To": "to@example.org",
             "Subject": "subject",
+            "Message-ID": "<956@example.org>",
         }
 
         def getitem(name):
@@ -68,12 +92,16 @@ class TestMain:
 
         tasks_from_email.imap_connect.assert_called_once()
         tasks_from_email.imap_search_unseen.assert_called_once()
-        imap_connection.fetch.assert_called_once_with("a", "(RFC822)")
+        assert imap_connection.uid.call_args_list == [
+            call("fetch", b"a", "(BODY.PEEK[])"),
+            call("store", b"a", "+FLAGS", "(\\Seen)"),
+        ]
         email.message_from_bytes.assert_called_once_with(b"raw")
         tasks_from_email.convert_to_kb_date.assert_has_calls(
             [call("rfcdate"), call("rfcdate", 48)]
         )
         assert email_message.__getitem__.call_args_list == [
+            call("Message-ID"),
             call("Date"),
             call("Date"),
             call("From"),
@@ -85,7 +113,7 @@ class TestMain:
         kb.add_group_member.assert_not_called()
         kb.get_project_by_name.assert_called_once_with(name="Support")
         tasks_from_email.get_task_if_subject_matches.assert_called_once_with(
-            kb, "ExampleHeader"
+            kb, "ExampleHeader", {}
         )
         if create:
             kb.create_task.assert_called_once_with(
@@ -96,11 +124,27 @@ class TestMain:
                 date_due="converted-date",
                 description="From: from@example.org\n\nTo: to@example.org\n\nDate: converted-date\n\nSubject: ExampleHeader\n\nNone",
             )
-            tasks_from_email.reopen_and_update.assert_not_called()
+            tasks_from_email.reopen_and_update_batch.assert_not_called()
         else:
             kb.create_task.assert_not_called()
-            tasks_from_email.reopen_and_update.called_once_with(
-                kb, {"is_active": True}, 1, 2, "None", "converted-date"
+            tasks_from_email.reopen_and_update_batch.assert_called_once_with(
+                kb,
+                {"is_active": True},
+                1,
+                [
+                    {
+                        "uid": b"a",
+                        "user_id": 2,
+                        "text": "From: from@example.org\n\nTo: to@example.org\n\nDate: converted-date\n\nSubject: ExampleHeader\n\nNone",
+                        "date_started": "converted-date",
+                        "date_due": "converted-date",
+                        "subject": "ExampleHeader",
+                        "message_id": "<956@example.org>",
+                        "raw_email": b"raw",
+                        "attachments": {"ExampleHeader.mbox": b"cmF3"},
+                    }
+                ],
+                None,
             )
         kb.create_task_file.assert_called_once_with(
             project_id="1",
@@ -110,3 +154,224 @@ class TestMain:
         )
 
         tasks_from_email.imap_close.assert_called_once()
+
+    def test_call_coalesces_replies_to_same_task(self, mocker, kb):
+        mocker.patch("tasks_from_email.imap_connect")
+        mocker.patch("tasks_from_email.imap_search_unseen")
+        mocker.patch("tasks_from_email.imap_close")
+        mocker.patch("tasks_from_email.create_user_for_sender")
+        mocker.patch("kanboard.Client")
+
+        raw_emails = {
+            b"1": b"From: a@example.org\r\nTo: to@example.org\r\nDate: Tue, 21 Nov 1995 08:00:00 +0000\r\nSubject: Re: [KB#956] later\r\n\r\nlater\r\n",
+            b"2": b"From: b@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 08:00:00 +0000\r\nSubject: Re: [KB#956] earlier\r\n\r\nearlier\r\n",
+        }
+        imap_connection = mock_imap_connection(raw_emails)
+        tasks_from_email.imap_connect.return_value = imap_connection
+        tasks_from_email.imap_search_unseen.return_value = ("typ", [b"1 2"])
+        tasks_from_email.create_user_for_sender.return_value = 2
+        kanboard.Client.return_value = kb
+        kb.get_project_by_name.return_value = {"id": 1}
+        kb.get_task.return_value = {"is_active": 0}
+
+        tasks_from_email.main()
+
+        kb.get_task.assert_called_once_with(task_id="956")
+        kb.open_task.assert_called_once_with(task_id="956")
+        comments = [c.kwargs["content"] for c in kb.create_comment.call_args_list]
+        assert len(comments) == 2
+        assert comments[0].endswith("earlier\r\n\r\n")
+        assert comments[1].endswith("later\r\n\r\n")
+        kb.update_task.assert_called_once_with(
+            id="956",
+            date_due=tasks_from_email.convert_to_kb_date("Tue, 21 Nov 1995 08:00:00 +0000", 48),
+        )
+        kb.create_task.assert_not_called()
+        assert kb.create_task_file.call_count == 2
+        assert imap_connection.seen == {b"1", b"2"}
+
+    def test_call_skips_mails_claimed_by_other_workers(self, mocker, kb, tmp_path):
+        mocker.patch("tasks_from_email.imap_connect")
+        mocker.patch("tasks_from_email.imap_search_unseen")
+        mocker.patch("tasks_from_email.imap_close")
+        mocker.patch("tasks_from_email.create_user_for_sender")
+        mocker.patch("kanboard.Client")
+        mocker.patch.dict(environ, {"WORKER_LEASE_DB": str(tmp_path / "leases.db")})
+
+        raw_email = b"From: a@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 08:00:00 +0000\r\nSubject: Re: [KB#956] reply\r\n\r\nreply\r\n"
+        """ uid 3 was handled by a worker whose claim expired since we searched """
+        imap_connection = mock_imap_connection({b"2": raw_email}, seen={b"3"})
+        imap_connection.response.return_value = ("UIDVALIDITY", [b"42"])
+        tasks_from_email.imap_connect.return_value = imap_connection
+        tasks_from_email.imap_search_unseen.return_value = ("typ", [b"1 2 3"])
+        tasks_from_email.create_user_for_sender.return_value = 2
+        kanboard.Client.return_value = kb
+        kb.get_project_by_name.return_value = {"id": 1}
+        kb.get_task.return_value = {"is_active": 1}
+
+        other_worker = tasks_from_email.LeaseStore(str(tmp_path / "leases.db"), worker_id="other")
+        assert other_worker.acquire("message:42:1")
+
+        tasks_from_email.main()
+
+        assert imap_connection.uid.call_args_list == [
+            call("fetch", b"2", "(FLAGS)"),
+            call("fetch", b"2", "(BODY.PEEK[])"),
+            call("fetch", b"3", "(FLAGS)"),
+            call("store", b"2", "+FLAGS", "(\\Seen)"),
+        ]
+        kb.create_comment.assert_called_once()
+        kb.update_task.assert_called_once()
+        """ sender and task locks are released again, message claims are kept """
+        assert not other_worker.acquire("message:42:2")
+        assert other_worker.acquire("sender:a@example.org")
+        assert other_worker.acquire("task:956")
+
+    def test_call_with_profile_and_trace_memory(self, mocker, kb, tmp_path):
+        mocker.patch("tasks_from_email.imap_connect")
+        mocker.patch("tasks_from_email.imap_search_unseen")
+        mocker.patch("tasks_from_email.imap_close")
+        mocker.patch("tasks_from_email.create_user_for_sender")
+        mocker.patch("kanboard.Client")
+        mocker.patch.dict(
+            environ,
+            {
+                "PROFILE_FILE": str(tmp_path / "run.prof"),
+                "TRACE_MEMORY_FILE": str(tmp_path / "memory.jsonl"),
+            },
+        )
+
+        raw_emails = {
+            b"1": b"From: a@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 08:00:00 +0000\r\nMessage-ID: <1@example.org>\r\nSubject: new\r\n\r\nnew\r\n",
+            b"2": b"From: b@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 09:00:00 +0000\r\nMessage-ID: <2@example.org>\r\nSubject: Re: [KB#956] reply\r\n\r\nreply\r\n",
+        }
+        imap_connection = mock_imap_connection(raw_emails)
+        imap_connection.wire_bytes_received = imap_connection.bytes_received = 0
+        tasks_from_email.imap_connect.return_value = imap_connection
+        tasks_from_email.imap_search_unseen.return_value = ("typ", [b"1 2"])
+        tasks_from_email.create_user_for_sender.return_value = 2
+        kanboard.Client.return_value = kb
+        kb.get_project_by_name.return_value = {"id": 1}
+        kb.get_task.return_value = {"is_active": 1}
+        kb.create_task.return_value = 957
+
+        tasks_from_email.main()
+
+        stats = pstats.Stats(str(tmp_path / "run.prof"))
+        assert any(function == "walk_message_parts" for (_, _, function) in stats.stats)
+        with open(str(tmp_path / "memory.jsonl")) as report:
+            traces = [json.loads(line) for line in report]
+        assert [(t["phase"], t.get("uid"), t.get("message_id"), t.get("size"), t.get("task_id")) for t in traces] == [
+            ("message", "1", "<1@example.org>", len(raw_emails[b"1"]), None),
+            ("message", "2", "<2@example.org>", len(raw_emails[b"2"]), None),
+            ("task", None, None, None, "956"),
+        ]
+        assert [t["wire_bytes_received"] for t in traces[:2]] == [0, 0]
+        assert all("fetch_time" in t for t in traces[:2])
+        assert traces[2]["messages"] == [{"message_id": "<2@example.org>", "size": len(raw_emails[b"2"])}]
+        assert all("wall_time" in t and "memory_peak" in t and "top_allocations" in t for t in traces)
+
+    def test_call_applies_collected_replies_if_later_mail_fails(self, mocker, kb):
+        mocker.patch("tasks_from_email.imap_connect")
+        mocker.patch("tasks_from_email.imap_search_unseen")
+        mocker.patch("tasks_from_email.imap_close")
+        mocker.patch("tasks_from_email.create_user_for_sender")
+        mocker.patch("kanboard.Client")
+
+        raw_emails = {
+            b"1": b"From: a@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 08:00:00 +0000\r\nSubject: Re: [KB#956] reply\r\n\r\nreply\r\n",
+            b"2": b"From: b@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 09:00:00 +0000\r\nSubject: new\r\n\r\nnew\r\n",
+        }
+        imap_connection = mock_imap_connection(raw_emails)
+        tasks_from_email.imap_connect.return_value = imap_connection
+        tasks_from_email.imap_search_unseen.return_value = ("typ", [b"1 2"])
+        tasks_from_email.create_user_for_sender.return_value = 2
+        kanboard.Client.return_value = kb
+        kb.get_project_by_name.return_value = {"id": 1}
+        kb.get_task.return_value = {"is_active": 1}
+        kb.create_task.side_effect = kanboard.ClientError("kanboard is down")
+
+        with pytest.raises(kanboard.ClientError):
+            tasks_from_email.main()
+
+        tasks_from_email.imap_close.assert_called_once_with(imap_connection)
+        """ the failing mail is marked as read like the reply, so it can't block later runs """
+        assert imap_connection.seen == {b"1", b"2"}
+
+        kb.create_comment.assert_called_once()
+        assert kb.create_comment.call_args.kwargs["task_id"] == "956"
+        kb.update_task.assert_called_once()
+        kb.create_task_file.assert_called_once()
+
+    def test_call_rereads_task_under_lock_and_keeps_later_due_date(self, mocker, kb, tmp_path):
+        mocker.patch("tasks_from_email.imap_connect")
+        mocker.patch("tasks_from_email.imap_search_unseen")
+        mocker.patch("tasks_from_email.imap_close")
+        mocker.patch("tasks_from_email.create_user_for_sender")
+        mocker.patch("kanboard.Client")
+        path = str(tmp_path / "leases.db")
+        mocker.patch.dict(environ, {"WORKER_LEASE_DB": path})
+
+        raw_email = b"From: a@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 08:00:00 +0000\r\nSubject: Re: [KB#956] older reply\r\n\r\nolder\r\n"
+        imap_connection = mock_imap_connection({b"1": raw_email})
+        imap_connection.response.return_value = ("UIDVALIDITY", [b"42"])
+        tasks_from_email.imap_connect.return_value = imap_connection
+        tasks_from_email.imap_search_unseen.return_value = ("typ", [b"1"])
+        tasks_from_email.create_user_for_sender.return_value = 2
+        kanboard.Client.return_value = kb
+        kb.get_project_by_name.return_value = {"id": 1}
+
+        """ kanboard as seen by both workers, the other one holds the task lock """
+        later_due_date = str(int(datetime.datetime(1995, 12, 24, 12, 0).timestamp()))
+        task = {"is_active": 0, "date_due": "0"}
+        kb.get_task.side_effect = lambda task_id: dict(task)
+        other_worker = tasks_from_email.LeaseStore(path, worker_id="other")
+        assert other_worker.acquire("task:956")
+
+        def other_worker_updates_task():
+            task.update(is_active=1, date_due=later_due_date)
+            """ sqlite connections can't be shared between threads """
+            tasks_from_email.LeaseStore(path, worker_id="other").release("task:956")
+
+        timer = threading.Timer(0.2, other_worker_updates_task)
+        timer.start()
+        tasks_from_email.main()
+        timer.join()
+
+        assert kb.get_task.call_count == 2
+        kb.open_task.assert_not_called()
+        kb.create_comment.assert_called_once()
+        kb.update_task.assert_not_called()
+
+    def test_call_applies_other_tasks_if_one_task_fails(self, mocker, kb, caplog):
+        mocker.patch("tasks_from_email.imap_connect")
+        mocker.patch("tasks_from_email.imap_search_unseen")
+        mocker.patch("tasks_from_email.imap_close")
+        mocker.patch("tasks_from_email.create_user_for_sender")
+        mocker.patch("kanboard.Client")
+
+        raw_emails = {
+            b"1": b"From: a@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 08:00:00 +0000\r\nSubject: Re: [KB#956] reply\r\n\r\nreply\r\n",
+            b"2": b"From: b@example.org\r\nTo: to@example.org\r\nDate: Mon, 20 Nov 1995 09:00:00 +0000\r\nSubject: Re: [KB#957] reply\r\n\r\nreply\r\n",
+        }
+        imap_connection = mock_imap_connection(raw_emails)
+        tasks_from_email.imap_connect.return_value = imap_connection
+        tasks_from_email.imap_search_unseen.return_value = ("typ", [b"1 2"])
+        tasks_from_email.create_user_for_sender.return_value = 2
+        kanboard.Client.return_value = kb
+        kb.get_project_by_name.return_value = {"id": 1}
+        kb.get_task.return_value = {"is_active": 1}
+
+        def create_comment(task_id, user_id, content):
+            if task_id == "956":
+                raise kanboard.ClientError("task 956 is broken")
+
+        kb.create_comment.side_effect = create_comment
+
+        with pytest.raises(kanboard.ClientError):
+            tasks_from_email.main()
+
+        assert [c.kwargs["task_id"] for c in kb.create_comment.call_args_list] == ["956", "957"]
+        """ the replies of the failed task stay unread and get retried by the next run """
+        assert imap_connection.seen == {b"2"}
+        assert "applying 1 replies to task 956 failed" in caplog.text
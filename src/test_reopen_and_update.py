@@ -1,6 +1,9 @@
+import datetime
+
 import pytest
+from unittest.mock import call
 
-from tasks_from_email import reopen_and_update
+from tasks_from_email import kb_date_sort_key, reopen_and_update, reopen_and_update_batch
 
 
 class TestReopenAndUpdate:
@@ -21,3 +24,80 @@ class TestReopenAndUpdate:
     def test_call_update_task_with_args(self, kb):
         reopen_and_update(kb, {"is_active": 1}, 956, None, None, "20.11.1995 12:00")
         kb.update_task.assert_called_with(id=956, date_due="20.11.1995 12:00")
+
+
+class TestReopenAndUpdateBatch:
+    def reply(self, text, date_started, date_due):
+        return {"user_id": 2, "text": text, "date_started": date_started, "date_due": date_due}
+
+    @pytest.mark.parametrize(
+        "kb_task,open_called", [({"is_active": 1}, False), ({"is_active": 0}, True),]
+    )
+    def test_call_open_task_once(self, kb, kb_task, open_called):
+        kb_replies = [
+            self.reply("a", "20.11.1995 12:00", "22.11.1995 12:00"),
+            self.reply("b", "20.11.1995 13:00", "22.11.1995 13:00"),
+        ]
+        reopen_and_update_batch(kb, kb_task, 956, kb_replies)
+        if open_called:
+            kb.open_task.assert_called_once_with(task_id=956)
+        else:
+            assert not kb.open_task.called
+
+    def test_call_create_comment_in_date_order(self, kb):
+        kb_replies = [
+            self.reply("second", "21.11.1995 08:00", "23.11.1995 08:00"),
+            self.reply("undated", None, None),
+            self.reply("first", "20.11.1995 13:00", "22.11.1995 13:00"),
+            self.reply("third", "01.12.1995 00:00", "03.12.1995 00:00"),
+        ]
+        reopen_and_update_batch(kb, {"is_active": 1}, 956, kb_replies)
+        assert kb.create_comment.call_args_list == [
+            call(task_id=956, user_id=2, content="undated"),
+            call(task_id=956, user_id=2, content="first"),
+            call(task_id=956, user_id=2, content="second"),
+            call(task_id=956, user_id=2, content="third"),
+        ]
+
+    def test_call_update_task_once_with_latest_due_date(self, kb):
+        kb_replies = [
+            self.reply("a", "30.11.1995 12:00", "02.12.1995 12:00"),
+            self.reply("b", "20.11.1995 12:00", "22.11.1995 12:00"),
+        ]
+        reopen_and_update_batch(kb, {"is_active": 1}, 956, kb_replies)
+        kb.update_task.assert_called_once_with(id=956, date_due="02.12.1995 12:00")
+
+    @pytest.mark.parametrize(
+        "previous_date_due,date_due,update_called",
+        [
+            # single worker, a reply always sets the due date
+            (None, "0", True),
+            (None, str(int(datetime.datetime(1995, 12, 5, 12, 0).timestamp())), True),
+            # unchanged since it was read, a reply always sets the due date
+            ("0", "0", True),
+            ("818164800", "818164800", True),
+            # changed by another worker, only moved later
+            ("0", str(int(datetime.datetime(1995, 11, 22, 12, 0).timestamp())), True),
+            ("0", str(int(datetime.datetime(1995, 12, 2, 12, 0).timestamp())), False),
+            ("0", str(int(datetime.datetime(1995, 12, 5, 12, 0).timestamp())), False),
+        ],
+    )
+    def test_update_due_date(self, kb, previous_date_due, date_due, update_called):
+        kb_replies = [self.reply("a", "30.11.1995 12:00", "02.12.1995 12:00")]
+        reopen_and_update_batch(kb, {"is_active": 1, "date_due": date_due}, 956, kb_replies, previous_date_due)
+        assert kb.update_task.called == update_called
+
+    def test_without_due_date(self, kb):
+        reopen_and_update_batch(kb, {"is_active": 1}, 956, [self.reply("a", None, None)])
+        kb.update_task.assert_called_once_with(id=956, date_due=None)
+
+    def test_without_due_date_changed_by_other_worker(self, kb):
+        reopen_and_update_batch(kb, {"is_active": 1, "date_due": "818164800"}, 956, [self.reply("a", None, None)], "0")
+        kb.update_task.assert_not_called()
+
+class TestKbDateSortKey:
+    def test_orders_by_date_not_string(self):
+        assert kb_date_sort_key("01.12.1995 00:00") > kb_date_sort_key("20.11.1995 12:00")
+
+    def test_missing_date_sorts_first(self):
+        assert kb_date_sort_key(None) < kb_date_sort_key("01.01.1970 00:00")
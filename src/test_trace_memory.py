@@ -0,0 +1,78 @@
+import pytest
+import email
+import io
+import json
+import tracemalloc
+
+from email.message import EmailMessage
+
+import tasks_from_email
+from tasks_from_email import trace_memory, walk_message_parts
+
+
+class TestTraceMemory:
+    def test_without_report(self):
+        with trace_memory(None, phase="message") as trace:
+            trace["uid"] = "956"
+        assert trace == {"phase": "message", "uid": "956"}
+        assert not tracemalloc.is_tracing()
+
+    def test_with_report(self):
+        report = io.StringIO()
+
+        with trace_memory(report, top_allocations=3, phase="message") as trace:
+            assert tracemalloc.is_tracing()
+            trace["message_id"] = "<956@example.org>"
+            data = [bytes(1024) for i in range(100)]
+
+        assert not tracemalloc.is_tracing()
+        result = json.loads(report.getvalue())
+        assert result["phase"] == "message"
+        assert result["message_id"] == "<956@example.org>"
+        assert result["wall_time"] > 0
+        assert result["memory_peak"] >= 100 * 1024
+        assert len(result["top_allocations"]) == 3
+        assert result["top_allocations"][0]["file"] == __file__
+        assert set(result["top_allocations"][0]) == {"file", "line", "size", "count", "traceback"}
+        assert result["top_allocations"][0]["traceback"][-1].startswith(__file__ + ":")
+
+    def test_with_report_on_error(self):
+        report = io.StringIO()
+
+        with pytest.raises(RuntimeError):
+            with trace_memory(report, phase="task", task_id="956"):
+                raise RuntimeError()
+
+        assert not tracemalloc.is_tracing()
+        assert json.loads(report.getvalue())["task_id"] == "956"
+
+    def test_attributes_allocations_to_script_lines(self):
+        """ the attachment gets decoded and encoded by the standard library on behalf of walk_message_parts """
+        mail = EmailMessage()
+        mail.set_content("body")
+        mail.add_attachment(bytes(range(256)) * 4096, maintype="application", subtype="octet-stream", filename="big.bin")
+        mail = email.message_from_bytes(mail.as_bytes())
+        report = io.StringIO()
+
+        with trace_memory(report, top_allocations=1):
+            body, attachments = walk_message_parts(mail)
+
+        allocation = json.loads(report.getvalue())["top_allocations"][0]
+        assert allocation["file"] == tasks_from_email.__file__
+        assert allocation["size"] >= len(attachments["big.bin"])
+        assert not allocation["traceback"][-1].startswith(tasks_from_email.__file__ + ":")
+
+    def test_keeps_tracing_that_was_running(self):
+        report = io.StringIO()
+        tracemalloc.start(5)
+        try:
+            with trace_memory(report, phase="message"):
+                data = [bytes(1024) for i in range(100)]
+            assert tracemalloc.is_tracing()
+            assert tracemalloc.get_traceback_limit() == 5
+        finally:
+            tracemalloc.stop()
+
+        result = json.loads(report.getvalue())
+        assert result["top_allocations"][0]["file"] == __file__
+        assert result["top_allocations"][0]["size"] >= 100 * 1024